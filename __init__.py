@@ -1,6 +1,7 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
 from trytond.pool import Pool
+from . import ir
 from . import payment
 from . import statement
 
@@ -8,9 +9,14 @@ from . import statement
 def register():
     Pool.register(
         payment.Journal,
+        payment.Group,
         payment.Payment,
+        payment.ProcessingEvent,
+        ir.Cron,
         module='account_payment_processing', type_='model')
     Pool.register(
+        statement.Journal,
+        statement.StatementLine,
         statement.StatementMoveLine,
         depends='account_bank_statement_payment',
         module='account_payment_processing', type_='model')
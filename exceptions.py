@@ -0,0 +1,11 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.exceptions import UserError, UserWarning
+
+
+class ProcessingError(UserError):
+    pass
+
+
+class ProcessingWarning(UserWarning):
+    pass
@@ -0,0 +1,298 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""Payment processing metrics in Prometheus text format.
+
+Metrics are counted in memory per process and added at most once per
+``metrics_interval`` to the totals shared by all the processes. The totals are
+kept next to the file set by the ``metrics_path`` option of the
+``account_payment_processing`` section of the trytond configuration and
+rendered to it, so a local node exporter textfile collector can pick them up.
+The counts left are added when the process exits so short-lived workers are
+not lost. Nothing is written if the option is not set.
+"""
+import atexit
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import trytond.config as config
+
+SECTION = 'account_payment_processing'
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+logger = logging.getLogger(__name__)
+_lock = threading.Lock()
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter(object):
+    type_ = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        with _lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def reset(self):
+        self._values = {}
+
+    def drain(self):
+        "Return the values counted since the last call and reset them"
+        values, self._values = self._values, {}
+        return values
+
+    @staticmethod
+    def merge(values, other):
+        for labels, value in other.items():
+            values[labels] = values.get(labels, 0) + value
+
+    def samples(self, values=None):
+        if values is None:
+            values = self._values
+        for labels, value in sorted(values.items()):
+            yield self.name, list(zip(self.labelnames, labels)), value
+
+
+class Histogram(object):
+    type_ = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._values = {}
+
+    def observe(self, value, *labels):
+        with _lock:
+            counts, total = self._values.get(
+                labels, ([0] * len(self.buckets), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[labels] = (counts, total + value)
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, *labels)
+
+    def reset(self):
+        self._values = {}
+
+    def drain(self):
+        "Return the values observed since the last call and reset them"
+        values, self._values = self._values, {}
+        return values
+
+    @staticmethod
+    def merge(values, other):
+        for labels, (counts, total) in other.items():
+            if labels in values:
+                previous, previous_total = values[labels]
+                counts = [a + b for a, b in zip(previous, counts)]
+                total += previous_total
+            values[labels] = (list(counts), total)
+
+    def samples(self, values=None):
+        if values is None:
+            values = self._values
+        for labels, (counts, total) in sorted(values.items()):
+            pairs = list(zip(self.labelnames, labels))
+            for bound, count in zip(self.buckets, counts):
+                yield (self.name + '_bucket',
+                    pairs + [('le', _format_value(bound))], count)
+            yield self.name + '_count', pairs, counts[-1]
+            yield self.name + '_sum', pairs, total
+
+
+payments = Counter('account_payment_processing_payments_total',
+    'Payments handled by the processing workflow', ['operation'])
+processing_moves = Counter('account_payment_processing_moves_total',
+    'Processing moves created')
+reconciliations = Counter('account_payment_processing_reconcile_total',
+    'Reconcile calls made by the processing workflow')
+duration = Histogram('account_payment_processing_duration_seconds',
+    'Duration of the processing workflow transitions', ['operation'])
+
+METRICS = [payments, processing_moves, reconciliations, duration]
+_last_export = 0
+_timer = None
+
+
+def _reset():
+    "Start with empty metrics in a forked process"
+    global _lock, _last_export, _timer
+    _lock = threading.Lock()
+    _last_export = 0
+    _timer = None
+    for metric in METRICS:
+        metric.reset()
+
+
+os.register_at_fork(after_in_child=_reset)
+
+
+def timed(operation):
+    "Decorate a transition to record its duration and export the metrics"
+    def decorator(func):
+        @wraps(func)
+        def wrapper(cls, records, *args, **kwargs):
+            try:
+                with duration.time(operation):
+                    result = func(cls, records, *args, **kwargs)
+                payments.inc(operation, amount=len(records))
+                return result
+            finally:
+                export()
+        return wrapper
+    return decorator
+
+
+def render(values=None):
+    """Return the metrics in Prometheus text format
+
+    values is a mapping of metric name to the values to render instead of
+    the ones counted in memory."""
+    output = []
+    for metric in METRICS:
+        output.append('# HELP %s %s' % (metric.name, metric.help))
+        output.append('# TYPE %s %s' % (metric.name, metric.type_))
+        samples = metric.samples(
+            values.get(metric.name, {}) if values is not None else None)
+        for name, pairs, value in samples:
+            output.append('%s%s %s' % (
+                    name, _format_labels(pairs), _format_value(value)))
+    return '\n'.join(output) + '\n'
+
+
+def get_path():
+    "Return the metrics file"
+    return config.get(SECTION, 'metrics_path', default=None)
+
+
+def _load(path):
+    "Return the totals stored in path"
+    try:
+        with open(path) as fp:
+            data = json.load(fp)
+    except FileNotFoundError:
+        return {}
+    return {
+        name: {tuple(labels): value for labels, value in values}
+        for name, values in data.items()}
+
+
+def _dump(totals):
+    return json.dumps({
+            name: [[list(labels), value] for labels, value in values.items()]
+            for name, values in totals.items()})
+
+
+def _write(path, content):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.metrics')
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(content)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except OSError:
+        os.unlink(tmp)
+        raise
+
+
+@contextmanager
+def _file_lock(path):
+    "Serialize the update of the totals between the processes"
+    with open(path + '.lock', 'a') as fp:
+        if fcntl:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+def _schedule(delay):
+    "Export the metrics left at the end of the interval"
+    global _timer
+    if _timer is None:
+        _timer = threading.Timer(delay, _flush)
+        _timer.daemon = True
+        _timer.start()
+
+
+def _flush():
+    global _timer
+    with _lock:
+        _timer = None
+    export(force=True)
+
+
+def export(force=False):
+    "Add the metrics to the totals at most once per interval"
+    global _last_export
+    path = get_path()
+    if not path:
+        return
+    now = time.monotonic()
+    interval = config.getfloat(SECTION, 'metrics_interval', default=15)
+    with _lock:
+        if not force and now - _last_export < interval:
+            _schedule(interval - (now - _last_export))
+            return
+        _last_export = now
+        drained = {m.name: m.drain() for m in METRICS}
+    if not any(drained.values()) and os.path.exists(path):
+        return
+    try:
+        with _file_lock(path):
+            totals = _load(path + '.json')
+            for metric in METRICS:
+                metric.merge(
+                    totals.setdefault(metric.name, {}), drained[metric.name])
+            _write(path + '.json', _dump(totals))
+            _write(path, render(totals))
+    except OSError:
+        logger.warning('Unable to write metrics to %s', path, exc_info=True)
+        # keep the counts for the next export
+        with _lock:
+            for metric in METRICS:
+                metric.merge(metric._values, drained[metric.name])
+
+
+atexit.register(export, force=True)
@@ -1,14 +1,38 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import logging
+import multiprocessing
+import os
+import time
 from collections import defaultdict
+from concurrent import futures
 from decimal import Decimal
+from itertools import groupby
 
-from trytond.model import ModelView, Workflow, fields
+from sql import Flavor, Literal, Null, Select
+from sql.aggregate import Min, Sum
+from sql.conditionals import Case, Coalesce
+from sql.functions import Function
+from sql.operators import Exists, In, NotIn
+
+import trytond.config as config
+from trytond import backend
+from trytond.i18n import gettext
+from trytond.model import Index, ModelSQL, ModelView, Workflow, fields
+from trytond.model.exceptions import AccessError
+from trytond.modules.currency.fields import Monetary
 from trytond.pool import Pool, PoolMeta
-from trytond.pyson import Bool, Eval
+from trytond.pyson import Bool, Eval, TimeDelta
+from trytond.rpc import RPC
+from trytond.tools import (
+    grouped_slice, reduce_ids, sortable_values, sqlite_apply_types)
 from trytond.transaction import Transaction
 
-__all__ = ['Journal', 'Payment']
+from . import metrics
+from .exceptions import ProcessingError, ProcessingWarning
+
+__all__ = ['Journal', 'Group', 'Payment', 'ProcessingEvent']
+logger = logging.getLogger(__name__)
 
 
 class Journal(metaclass=PoolMeta):
@@ -21,6 +45,18 @@ class Journal(metaclass=PoolMeta):
         'Processing Journal', states={
             'required': Bool(Eval('processing_account')),
             })
+    processing_succeed_delay = fields.TimeDelta(
+        "Processing Succeed Delay",
+        domain=['OR',
+            ('processing_succeed_delay', '=', None),
+            ('processing_succeed_delay', '>=', TimeDelta()),
+            ],
+        states={
+            'invisible': ~Bool(Eval('processing_journal')),
+            },
+        help="Succeed automatically the processing payments after the delay "
+        "from their date.\n"
+        "Leave empty for no automatic succeed.")
 
     @classmethod
     def __setup__(cls):
@@ -31,18 +67,180 @@ class Journal(metaclass=PoolMeta):
         cls.processing_journal.depends.add('company')
 
 
+class Group(metaclass=PoolMeta):
+    __name__ = 'account.payment.group'
+    processing_amount = fields.Function(Monetary(
+            'Processing Amount', currency='currency', digits='currency',
+            help="The amount moved to the processing account by the "
+            "processing moves of the payments."),
+        'get_processing_amounts')
+    processing_pending_amount = fields.Function(Monetary(
+            'Processing Pending Amount', currency='currency',
+            digits='currency',
+            help="The part of the processing amount not yet reconciled."),
+        'get_processing_amounts')
+    processing_failed_amount = fields.Function(Monetary(
+            'Processing Failed Amount', currency='currency',
+            digits='currency',
+            help="The amount of the failed payments of journals with "
+            "processing.\n"
+            "It is the payment amount as their processing moves are "
+            "cancelled."),
+        'get_processing_amounts')
+
+    @classmethod
+    def get_processing_amounts(cls, groups, names):
+        pool = Pool()
+        Payment = pool.get('account.payment')
+        Journal = pool.get('account.payment.journal')
+        Line = pool.get('account.move.line')
+        cursor = Transaction().connection.cursor()
+        payment = Payment.__table__()
+        journal = Journal.__table__()
+        line = Line.__table__()
+
+        result = {n: {g.id: Decimal(0) for g in groups} for n in names}
+        for sub_groups in grouped_slice(groups):
+            sub_ids = [g.id for g in sub_groups]
+
+            # amounts of the processing account lines, in the journal
+            # currency
+            line_payment = Payment.__table__()
+            line_journal = Journal.__table__()
+            line_amount = Case((line.second_currency != Null,
+                    line.amount_second_currency),
+                else_=line.debit - line.credit)
+            lines = (line_payment
+                .join(line_journal,
+                    condition=line_payment.journal == line_journal.id)
+                .join(line,
+                    condition=(line.move == line_payment.processing_move)
+                    & (line.account == line_journal.processing_account))
+                .select(line_payment.id.as_('payment'),
+                    Sum(line_amount).as_('amount'),
+                    Sum(line_amount,
+                        filter_=line.reconciliation == Null).as_('pending'),
+                    where=reduce_ids(line_payment.group, sub_ids),
+                    group_by=line_payment.id))
+
+            columns = {
+                'processing_amount': Sum(Coalesce(lines.amount, 0)),
+                'processing_pending_amount': Sum(Coalesce(lines.pending, 0)),
+                'processing_failed_amount': Sum(payment.amount,
+                    filter_=payment.state == 'failed'),
+                }
+            query = (payment
+                .join(journal, condition=payment.journal == journal.id)
+                .join(lines, 'LEFT',
+                    condition=lines.payment == payment.id))
+            cursor.execute(*query.select(payment.group,
+                    *(columns[n] for n in names),
+                    where=reduce_ids(payment.group, sub_ids)
+                    & (journal.processing_account != Null),
+                    group_by=payment.group))
+            for row in cursor:
+                group_id = row[0]
+                for name, value in zip(names, row[1:]):
+                    # SQLite returns float for SUM
+                    if value is not None and not isinstance(value, Decimal):
+                        value = Decimal(str(value))
+                    result[name][group_id] = abs(value or Decimal(0))
+
+        for group in groups:
+            for name in names:
+                result[name][group.id] = group.currency.round(
+                    result[name][group.id])
+        return result
+
+
 class Payment(metaclass=PoolMeta):
     __name__ = 'account.payment'
     processing_move = fields.Many2One('account.move', 'Processing Move',
         readonly=True)
+    processing_status = fields.Function(fields.Selection([
+                (None, ""),
+                ('open', "Open"),
+                ('reconciled', "Reconciled"),
+                ('cancelled', "Cancelled"),
+                ], "Processing Status"),
+        'get_processing_status', searcher='search_processing_status')
+
+    @classmethod
+    def _processing_status_query(cls):
+        "Return the payment table and the processing status column"
+        pool = Pool()
+        Journal = pool.get('account.payment.journal')
+        Line = pool.get('account.move.line')
+        Event = pool.get('account.payment.processing.event')
+        payment = cls.__table__()
+        journal = Journal.__table__()
+        line = Line.__table__()
+        event = Event.__table__()
+
+        open_lines = line.select(line.id,
+            where=(line.move == payment.processing_move)
+            & (line.account == journal.processing_account)
+            & (line.reconciliation == Null))
+        # only the posted processing moves are cancelled when failing
+        cancelled = event.select(event.payment.as_('payment'),
+            where=(event.kind == 'fail') & (event.move != Null),
+            group_by=event.payment)
+        status = Case(
+            ((payment.processing_move != Null) & Exists(open_lines), 'open'),
+            (payment.processing_move != Null, 'reconciled'),
+            ((payment.state == 'failed') & (cancelled.payment != Null),
+                'cancelled'),
+            else_=Null)
+        query = (payment
+            .join(journal, condition=payment.journal == journal.id)
+            .join(cancelled, 'LEFT',
+                condition=cancelled.payment == payment.id))
+        return query, payment, status
+
+    @classmethod
+    def get_processing_status(cls, payments, name):
+        cursor = Transaction().connection.cursor()
+        query, payment, status = cls._processing_status_query()
+        result = {}
+        for sub_payments in grouped_slice(payments):
+            cursor.execute(*query.select(payment.id, status,
+                    where=reduce_ids(payment.id,
+                        [p.id for p in sub_payments])))
+            result.update(cursor)
+        return result
+
+    @classmethod
+    def search_processing_status(cls, name, clause):
+        _, operator, value = clause
+        Operator = fields.SQL_OPERATORS[operator]
+        field = cls._fields[name]
+        query, payment, status = cls._processing_status_query()
+        if value is None:
+            expression = Operator(status, Null)
+        else:
+            # None in the values of in and not in is converted like for
+            # stored fields
+            expression = Operator(
+                status, field._domain_value(operator, value))
+            if isinstance(expression, In) and not expression.right:
+                expression = Literal(False)
+            elif isinstance(expression, NotIn) and not expression.right:
+                expression = Literal(True)
+            expression = field._domain_add_null(
+                status, operator, value, expression)
+        return [('id', 'in', query.select(payment.id, where=expression))]
 
     @classmethod
     @Workflow.transition('processing')
+    @metrics.timed('process')
     def process(cls, payments, group):
         pool = Pool()
+        Event = pool.get('account.payment.processing.event')
         Move = pool.get('account.move')
         Line = pool.get('account.move.line')
 
+        cls.check_processing(payments)
+
         group = super(Payment, cls).process(payments, group)
 
         moves = []
@@ -52,9 +250,11 @@ class Payment(metaclass=PoolMeta):
                 moves.append(move)
         if moves:
             Move.save(moves)
+            metrics.processing_moves.inc(amount=len(moves))
             cls.write(*sum((([m.origin], {'processing_move': m.id})
                         for m in moves), ()))
             Move.post(moves)
+            Event.log('process', [(m.origin, m) for m in moves])
 
         to_reconcile = defaultdict(list)
         for payment in payments:
@@ -67,9 +267,138 @@ class Payment(metaclass=PoolMeta):
                     to_reconcile[payment.party].extend(lines)
         for lines in list(to_reconcile.values()):
             Line.reconcile(lines)
+        metrics.reconciliations.inc(amount=len(to_reconcile))
 
         return group
 
+    @classmethod
+    def check_processing(cls, payments, date=None):
+        "Check that processing moves can be created for all the payments"
+        pool = Pool()
+        Warning = pool.get('res.user.warning')
+
+        errors, no_line = cls.get_processing_errors(payments, date=date)
+        if errors:
+            raise ProcessingError(
+                gettext('account_payment_processing'
+                    '.msg_payment_processing_errors'),
+                '\n'.join(errors))
+        if no_line:
+            key = Warning.format('processing_no_line', no_line)
+            if Warning.check(key):
+                raise ProcessingWarning(key,
+                    gettext('account_payment_processing'
+                        '.msg_payment_processing_no_line',
+                        payments=', '.join(p.rec_name for p in no_line[:5])
+                        + ('...' if len(no_line) > 5 else '')))
+
+    @classmethod
+    def get_processing_errors(cls, payments, date=None):
+        """Return the error messages preventing to process the payments and
+        the payments without line"""
+        pool = Pool()
+        Company = pool.get('company.company')
+        Currency = pool.get('currency.currency')
+        Date = pool.get('ir.date')
+        Journal = pool.get('account.payment.journal')
+        Lang = pool.get('ir.lang')
+        Period = pool.get('account.period')
+        Rate = pool.get('currency.currency.rate')
+        cursor = Transaction().connection.cursor()
+        payment = cls.__table__()
+        journal = Journal.__table__()
+        company = Company.__table__()
+        rate = Rate.__table__()
+
+        if date is None:
+            date = Date.today()
+        lang = Lang.get()
+
+        query = (payment
+            .join(journal, condition=payment.journal == journal.id)
+            .join(company, condition=payment.company == company.id))
+        configured = ((journal.processing_account != Null)
+            & (journal.processing_journal != Null))
+        incomplete = (
+            ((journal.processing_account != Null)
+                & (journal.processing_journal == Null))
+            | ((journal.processing_account == Null)
+                & (journal.processing_journal != Null)))
+
+        journal_ids, company_ids, no_line_ids = set(), set(), []
+        currency_dates = {}
+        for sub_payments in grouped_slice(payments):
+            where = reduce_ids(payment.id, [p.id for p in sub_payments])
+            cursor.execute(*query.select(journal.id,
+                    where=where & incomplete,
+                    group_by=journal.id))
+            journal_ids.update(j for j, in cursor)
+
+            cursor.execute(*query.select(payment.id,
+                    where=where & configured & (payment.line == Null)))
+            no_line_ids.extend(p for p, in cursor)
+
+            cursor.execute(*query.select(payment.company,
+                    where=where & configured & (payment.line != Null),
+                    group_by=payment.company))
+            company_ids.update(c for c, in cursor)
+
+            # rates of both currencies are used to compute the local amount
+            for currency in [journal.currency, company.currency]:
+                currency_query = query.select(
+                    currency, Min(payment.date).as_('date'),
+                    where=where & configured & (payment.line != Null)
+                    & (journal.currency != company.currency),
+                    group_by=currency)
+                if backend.name == 'sqlite':
+                    sqlite_apply_types(currency_query, [None, 'DATE'])
+                cursor.execute(*currency_query)
+                for currency_id, min_date in cursor:
+                    currency_dates[currency_id] = min(
+                        currency_dates.get(currency_id, min_date), min_date)
+
+        errors = []
+        for journal_ in Journal.browse(sorted(journal_ids)):
+            errors.append(gettext('account_payment_processing'
+                    '.msg_payment_processing_journal_incomplete',
+                    journal=journal_.rec_name))
+
+        if company_ids:
+            periods = Period.search([
+                    ('fiscalyear.company', 'in', list(company_ids)),
+                    ('start_date', '<=', date),
+                    ('end_date', '>=', date),
+                    ('type', '=', 'standard'),
+                    ('state', '=', 'open'),
+                    ])
+            company_ids -= {p.fiscalyear.company.id for p in periods}
+            for company_ in Company.browse(sorted(company_ids)):
+                errors.append(gettext('account_payment_processing'
+                        '.msg_payment_processing_period_not_open',
+                        company=company_.rec_name,
+                        date=lang.strftime(date)))
+
+        if currency_dates:
+            # a rate before the earliest date is valid for all the payments
+            rate_query = rate.select(
+                rate.currency, Min(rate.date).as_('date'),
+                where=reduce_ids(rate.currency, list(currency_dates)),
+                group_by=rate.currency)
+            if backend.name == 'sqlite':
+                sqlite_apply_types(rate_query, [None, 'DATE'])
+            cursor.execute(*rate_query)
+            first_rates = dict(cursor)
+            for currency in Currency.browse(sorted(currency_dates)):
+                min_date = currency_dates[currency.id]
+                if (currency.id not in first_rates
+                        or first_rates[currency.id] > min_date):
+                    errors.append(gettext('account_payment_processing'
+                            '.msg_payment_processing_currency_rate',
+                            currency=currency.rec_name,
+                            date=lang.strftime(min_date)))
+
+        return errors, cls.browse(no_line_ids)
+
     def create_processing_move(self, date=None):
         pool = Pool()
         Currency = pool.get('currency.currency')
@@ -141,11 +470,15 @@ class Payment(metaclass=PoolMeta):
     @classmethod
     @ModelView.button
     @Workflow.transition('succeeded')
+    @metrics.timed('succeed')
     def succeed(cls, payments):
         pool = Pool()
+        Event = pool.get('account.payment.processing.event')
         Line = pool.get('account.move.line')
 
         super(Payment, cls).succeed(payments)
+        Event.log('succeed',
+            [(p, p.clearing_move) for p in payments if p.processing_move])
 
         for payment in payments:
             if (payment.journal.processing_account
@@ -166,22 +499,58 @@ class Payment(metaclass=PoolMeta):
                 for lines in list(to_reconcile.values()):
                     if not sum((l.debit - l.credit) for l in lines):
                         Line.reconcile(lines)
+                        metrics.reconciliations.inc()
+
+    @classmethod
+    def set_clearing_move(cls, payments):
+        # read the processing accounts once for all the clearing moves
+        with Transaction().set_context(
+                _processing_accounts=cls._get_processing_accounts(payments)):
+            super(Payment, cls).set_clearing_move(payments)
+
+    @classmethod
+    def _get_processing_accounts(cls, payments):
+        """Return the processing account id and its party requirement per
+        journal id of the payments"""
+        pool = Pool()
+        Journal = pool.get('account.payment.journal')
+        journals = Journal.browse(list({p.journal.id for p in payments}))
+        return {
+            j.id: (
+                j.processing_account.id,
+                j.processing_account.party_required)
+            for j in journals if j.processing_account}
 
     def _get_clearing_move(self, date=None):
+        pool = Pool()
+        Account = pool.get('account.account')
+
         move = super(Payment, self)._get_clearing_move(date=date)
-        if move and self.processing_move:
-            for line in move.lines:
-                if line.account == self.line.account:
-                    line.account = self.journal.processing_account
-                    line.party = (self.line.party
-                        if line.account.party_required else None)
+        if move and not self.clearing_move and self.processing_move:
+            processing_accounts = Transaction().context.get(
+                '_processing_accounts')
+            if processing_accounts is None:
+                processing_accounts = self._get_processing_accounts([self])
+            if self.journal.id in processing_accounts:
+                account_id, party_required = processing_accounts[
+                    self.journal.id]
+                mapping = {
+                    self.line.account: (
+                        Account(account_id),
+                        self.line.party if party_required else None),
+                    }
+                for line in move.lines:
+                    if line.account in mapping:
+                        line.account, line.party = mapping[line.account]
         return move
 
     @classmethod
     @ModelView.button
     @Workflow.transition('failed')
+    @metrics.timed('fail')
     def fail(cls, payments):
         pool = Pool()
+        Event = pool.get('account.payment.processing.event')
         Move = pool.get('account.move')
         Line = pool.get('account.move.line')
         Reconciliation = pool.get('account.move.reconciliation')
@@ -192,16 +561,19 @@ class Payment(metaclass=PoolMeta):
         to_reconcile = defaultdict(lambda: defaultdict(list))
         to_unreconcile = []
         to_post = []
+        events = []
         for payment in payments:
             if payment.processing_move:
                 if payment.processing_move.state == 'draft':
                     to_delete.append(payment.processing_move)
+                    events.append((payment, None))
                     for line in payment.processing_move.lines:
                         if line.reconciliation:
                             to_unreconcile.append(line.reconciliation)
                 else:
                     cancel_move = payment.processing_move.cancel()
                     to_post.append(cancel_move)
+                    events.append((payment, cancel_move))
                     for line in (payment.processing_move.lines
                             + cancel_move.lines):
                         if line.reconciliation:
@@ -215,8 +587,306 @@ class Payment(metaclass=PoolMeta):
             Move.delete(to_delete)
         if to_post:
             Move.post(to_post)
+        Event.log('fail', events)
         for party in to_reconcile:
             for lines in list(to_reconcile[party].values()):
                 Line.reconcile(lines)
+                metrics.reconciliations.inc()
 
         cls.write(payments, {'processing_move': None})
+
+    @classmethod
+    def process_partitions(cls, date=None):
+        """Process and succeed the pending payments of each company in a
+        separate process
+
+        The processes are spawned and load the configuration files set by
+        the worker_config option of the account_payment_processing section
+        or by the TRYTOND_CONFIG environment variable."""
+        transaction = Transaction()
+
+        partitions = cls._get_partitions(date=date)
+        if not partitions:
+            return {}
+
+        # Companies do not share fiscal years so the post sequences of their
+        # processing moves are not locked by the other partitions.
+        # Spawn as the cron process is multi-threaded.
+        processes = config.getint(
+            'account_payment_processing', 'processes',
+            default=multiprocessing.cpu_count())
+        results = {}
+        with _get_executor(min(processes, len(partitions))) as executor:
+            tasks = {
+                executor.submit(_process_partition,
+                    transaction.database.name, transaction.user,
+                    dict(transaction.context, company=company_id),
+                    *partition): company_id
+                for company_id, partition in partitions.items()}
+            for task in futures.as_completed(tasks):
+                company_id = tasks[task]
+                try:
+                    results[company_id] = task.result()
+                except Exception as exception:
+                    logger.error(
+                        "Processing payments of company %s failed",
+                        company_id, exc_info=True)
+                    results[company_id] = (0, 0, str(exception))
+                else:
+                    logger.info(
+                        "Processing payments of company %s: "
+                        "%s processed, %s succeeded",
+                        company_id, *results[company_id][:2])
+        return results
+
+    @classmethod
+    def _get_partitions(cls, date=None):
+        """Return the ids of payments to process and to succeed per company
+
+        Processing payments are succeeded once the succeed delay of their
+        journal is passed."""
+        pool = Pool()
+        Date = pool.get('ir.date')
+
+        if date is None:
+            date = Date.today()
+        partitions = defaultdict(lambda: ([], []))
+        for payment in cls.search([
+                    ('journal.processing_journal', '!=', None),
+                    ['OR',
+                        ('state', '=', 'approved'),
+                        [
+                            ('state', '=', 'submitted'),
+                            ('kind', '=', 'receivable'),
+                            ],
+                        ('state', '=', 'processing'),
+                        ],
+                    ]):
+            to_process, to_succeed = partitions[payment.company.id]
+            if payment.state == 'processing':
+                delay = payment.journal.processing_succeed_delay
+                if delay is not None and payment.date <= date - delay:
+                    to_succeed.append(payment.id)
+            else:
+                to_process.append(payment.id)
+        return {k: v for k, v in partitions.items() if any(v)}
+
+    @classmethod
+    def process_partition(cls, process_ids, succeed_ids):
+        "Process and succeed the payments of a partition"
+        to_process = cls.browse(process_ids)
+        if to_process:
+            cls.process_grouped(to_process)
+        to_succeed = cls.browse(succeed_ids)
+        if to_succeed:
+            cls.succeed(to_succeed)
+
+    @classmethod
+    def _group_payment_key(cls, payment):
+        return (
+            ('company', payment.company),
+            ('journal', payment.journal),
+            ('kind', payment.kind),
+            )
+
+    @classmethod
+    def process_grouped(cls, payments):
+        "Process payments in groups like the process wizard"
+        pool = Pool()
+        Group = pool.get('account.payment.group')
+
+        process_method_with_group = cls.process_method_with_group()
+        groups = []
+        payments = sorted(
+            payments, key=sortable_values(cls._group_payment_key))
+        for key, grouped_payments in groupby(payments,
+                key=cls._group_payment_key):
+            def group():
+                group = Group(**dict(key))
+                group.save()
+                return group
+            process_method = dict(key)['journal'].process_method
+            group = cls.process(
+                list(grouped_payments),
+                group if process_method in process_method_with_group else None)
+            if group:
+                groups.append(group)
+        return groups
+
+
+class ProcessingEvent(ModelSQL):
+    __name__ = 'account.payment.processing.event'
+    company = fields.Many2One(
+        'company.company', "Company", required=True, readonly=True)
+    payment = fields.Many2One('account.payment', "Payment", readonly=True,
+        ondelete='SET NULL')
+    move = fields.Many2One('account.move', "Move", readonly=True,
+        ondelete='SET NULL')
+    kind = fields.Selection([
+            ('process', "Process"),
+            ('succeed', "Succeed"),
+            ('fail', "Fail"),
+            ], "Kind", required=True, readonly=True)
+    amount = Monetary(
+        "Amount", currency='currency', digits='currency', readonly=True)
+    currency = fields.Many2One(
+        'currency.currency', "Currency", required=True, readonly=True)
+    move_amount = fields.Numeric("Move Amount", readonly=True,
+        help="The total debit of the move in the company currency.")
+    transaction_id = fields.Integer("Transaction ID", readonly=True)
+    # the transaction ids of PostgreSQL are 64-bit and exceed the INTEGER
+    # column of the Integer fields
+    transaction_id._sql_type = 'BIGINT'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t, (t.payment, Index.Range()),
+                    where=(t.kind == 'fail') & (t.move != Null)),
+                Index(t,
+                    (t.transaction_id, Index.Range()),
+                    (t.id, Index.Range())),
+                })
+        cls._order.insert(0, ('id', 'ASC'))
+        cls.__rpc__.update({
+                'stream': RPC(),
+                })
+
+    @classmethod
+    def log(cls, kind, payment_moves):
+        "Create in bulk the events of kind for the (payment, move) pairs"
+        if payment_moves:
+            transaction_id = cls._get_transaction_id()
+            cls.create([
+                    dict(cls._get_values(kind, payment, move),
+                        transaction_id=transaction_id)
+                    for payment, move in payment_moves])
+
+    @classmethod
+    def _get_transaction_id(cls):
+        "Return the id of the current database transaction"
+        if backend.name == 'postgresql':
+            cursor = Transaction().connection.cursor()
+            cursor.execute(*Select([TxidCurrent()]))
+            transaction_id, = cursor.fetchone()
+            return transaction_id
+        # the other backends commit the writing transactions one by one
+        return 0
+
+    @classmethod
+    def _get_values(cls, kind, payment, move):
+        return {
+            'company': payment.company.id,
+            'payment': payment.id,
+            'move': move.id if move else None,
+            'kind': kind,
+            'amount': payment.amount,
+            'currency': payment.currency.id,
+            'move_amount': (
+                sum(l.debit for l in move.lines) if move else None),
+            }
+
+    @classmethod
+    def stream(cls, after=None, limit=1000):
+        """Return the events after the cursor in the order of their
+        transactions
+
+        Consumers must call it again with the cursor of the last event
+        received until an empty list is returned."""
+        domain = []
+        if backend.name == 'postgresql':
+            # The ids are allocated before the commit so a running transaction
+            # may still add events with lower ids. Only the events of the
+            # transactions older than the oldest running one are returned.
+            cursor = Transaction().connection.cursor()
+            cursor.execute(*Select([TxidSnapshotXmin(TxidCurrentSnapshot())]))
+            xmin, = cursor.fetchone()
+            domain.append(('transaction_id', '<', xmin))
+        if after:
+            transaction_id, id_ = after
+            domain.append(['OR',
+                    ('transaction_id', '>', transaction_id),
+                    [
+                        ('transaction_id', '=', transaction_id),
+                        ('id', '>', id_),
+                        ],
+                    ])
+        events = cls.search(domain,
+            order=[('transaction_id', 'ASC'), ('id', 'ASC')], limit=limit)
+        return [{
+                'id': e.id,
+                'cursor': [e.transaction_id, e.id],
+                'company': e.company.id,
+                'payment': e.payment.id if e.payment else None,
+                'move': e.move.id if e.move else None,
+                'kind': e.kind,
+                'amount': e.amount,
+                'currency': e.currency.id,
+                'move_amount': e.move_amount,
+                'timestamp': e.create_date,
+                } for e in events]
+
+    @classmethod
+    def check_modification(cls, mode, events, values=None, external=False):
+        super().check_modification(
+            mode, events, values=values, external=external)
+        # only clearing the references of deleted records is allowed
+        if ((mode == 'write'
+                    and (set(values) - {'payment', 'move'}
+                        or any(values.values())))
+                or mode == 'delete'):
+            raise AccessError(gettext(
+                    'account_payment_processing.msg_processing_event_modify'))
+
+
+class TxidCurrent(Function):
+    __slots__ = ()
+    _function = 'TXID_CURRENT'
+
+
+class TxidCurrentSnapshot(Function):
+    __slots__ = ()
+    _function = 'TXID_CURRENT_SNAPSHOT'
+
+
+class TxidSnapshotXmin(Function):
+    __slots__ = ()
+    _function = 'TXID_SNAPSHOT_XMIN'
+
+
+def _get_executor(max_workers):
+    "Return an executor of spawned processes loading the worker configuration"
+    configfile = config.get(
+        'account_payment_processing', 'worker_config',
+        default=os.environ.get('TRYTOND_CONFIG'))
+    # The configuration must be loaded before the first import of
+    # trytond.backend, which happens when the tasks are unpickled.
+    return futures.ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=config.update_etc, initargs=(configfile,))
+
+
+def _process_partition(
+        database_name, user, context, process_ids, succeed_ids):
+    pool = Pool(database_name)
+    if database_name not in Pool.database_list():
+        Flavor.set(backend.Database.flavor)
+        with Transaction().start(database_name, 0, readonly=True):
+            pool.init()
+    retry = config.getint('database', 'retry')
+    for count in range(retry, -1, -1):
+        if count != retry:
+            time.sleep(0.02 * (retry - count))
+        try:
+            with Transaction().start(database_name, user, context=context):
+                Payment = pool.get('account.payment')
+                Payment.process_partition(process_ids, succeed_ids)
+        except backend.DatabaseOperationalError:
+            if count:
+                continue
+            raise
+        break
+    return len(process_ids), len(succeed_ids), None
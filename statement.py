@@ -3,10 +3,116 @@
 from collections import defaultdict
 from decimal import Decimal
 
-from trytond.model import fields
+from trytond.model import ModelView, fields
 from trytond.pool import Pool, PoolMeta
+from trytond.pyson import Bool, Eval
 
-__all__ = ['StatementMoveLine']
+__all__ = ['Journal', 'StatementLine', 'StatementMoveLine']
+
+
+class Journal(metaclass=PoolMeta):
+    __name__ = 'account.payment.journal'
+    processing_statement_settle = fields.Boolean(
+        "Settle from Bank Statements",
+        states={
+            'invisible': ~Bool(Eval('processing_journal')),
+            },
+        help="Succeed or fail the processing payments when a bank statement "
+        "line on the processing account is posted.")
+
+
+class StatementLine(metaclass=PoolMeta):
+    __name__ = 'account.bank.statement.line'
+
+    @classmethod
+    @ModelView.button
+    def post(cls, statement_lines):
+        to_succeed, to_fail = cls.get_processing_settlements(statement_lines)
+        cls.reroute_processing_returns(to_fail)
+        super(StatementLine, cls).post(statement_lines)
+        cls.settle_processing_payments(to_succeed, to_fail)
+
+    @classmethod
+    def get_processing_settlements(cls, statement_lines):
+        """Return the processing payments settled and returned by the
+        statement lines on their processing account
+
+        Both are mappings of the payment to its statement move lines."""
+        lines = defaultdict(list)
+        for statement_line in statement_lines:
+            for line in statement_line.lines:
+                payment = line.payment
+                if (not payment
+                        or payment.state != 'processing'
+                        or not payment.processing_move
+                        or not payment.journal.processing_statement_settle
+                        or line.account != payment.journal.processing_account):
+                    continue
+                lines[payment].append(line)
+
+        to_succeed, to_fail = {}, {}
+        for payment, payment_lines in lines.items():
+            amounts = [l.amount for l in payment_lines]
+            # leave for the user payments both settled and returned or
+            # settled partially
+            if (not all(a > 0 for a in amounts)
+                    and not all(a < 0 for a in amounts)):
+                continue
+            if abs(sum(amounts)) != cls._get_processing_amount(payment):
+                continue
+            # money received for receivable or sent for payable
+            if (amounts[0] > 0) == (payment.kind == 'receivable'):
+                to_succeed[payment] = payment_lines
+            elif payment.line:
+                to_fail[payment] = payment_lines
+        return to_succeed, to_fail
+
+    @classmethod
+    def _get_processing_amount(cls, payment):
+        "Return the amount of the payment on its processing account"
+        amount = 0
+        for line in payment.processing_move.lines:
+            if line.account == payment.journal.processing_account:
+                if line.second_currency:
+                    amount += line.amount_second_currency
+                else:
+                    amount += line.debit - line.credit
+        return abs(amount)
+
+    @classmethod
+    def reroute_processing_returns(cls, to_fail):
+        """Move the returned amounts to the account of the payment lines
+        because the processing moves are cancelled"""
+        pool = Pool()
+        StatementMoveLine = pool.get('account.bank.statement.move.line')
+
+        to_write = []
+        for payment, lines in to_fail.items():
+            to_write.extend((lines, {
+                        'account': payment.line.account.id,
+                        'party': (
+                            payment.line.party.id
+                            if payment.line.party else None),
+                        }))
+        if to_write:
+            StatementMoveLine.write(*to_write)
+
+    @classmethod
+    def settle_processing_payments(cls, to_succeed, to_fail):
+        "Succeed and fail at once the processing payments"
+        pool = Pool()
+        Payment = pool.get('account.payment')
+        StatementMoveLine = pool.get('account.bank.statement.move.line')
+
+        if to_succeed:
+            Payment.succeed(list(to_succeed))
+            # the moves are created before the payments succeed
+            for line in StatementMoveLine.browse(
+                    sum(to_succeed.values(), [])):
+                if line.move:
+                    line.reconcile_processing_move(line.move)
+        if to_fail:
+            Payment.fail(list(to_fail))
 
 
 class StatementMoveLine(metaclass=PoolMeta):
@@ -45,26 +151,31 @@ class StatementMoveLine(metaclass=PoolMeta):
         return changes
 
     def create_move(self):
-        pool = Pool()
-        MoveLine = pool.get('account.move.line')
-
         move = super(StatementMoveLine, self).create_move()
 
         if (self.payment and self.payment.state == 'succeeded'
                 and self.payment.processing_move):
-            to_reconcile = defaultdict(list)
-            lines = (move.lines + self.payment.processing_move.lines
-                + (self.payment.line,))
-
-            if self.payment.clearing_move:
-                lines += self.payment.clearing_move.lines
-
-            for line in lines:
-                if line.account.reconcile and not line.reconciliation:
-                    key = (
-                        line.account.id,
-                        line.party.id if line.party else None)
-                    to_reconcile[key].append(line)
-            for lines in list(to_reconcile.values()):
-                if not sum((l.debit - l.credit) for l in lines):
-                    MoveLine.reconcile(lines)
+            self.reconcile_processing_move(move)
+        return move
+
+    def reconcile_processing_move(self, move):
+        "Reconcile the move with the processing move of the payment"
+        pool = Pool()
+        MoveLine = pool.get('account.move.line')
+
+        to_reconcile = defaultdict(list)
+        lines = (move.lines + self.payment.processing_move.lines
+            + (self.payment.line,))
+
+        if self.payment.clearing_move:
+            lines += self.payment.clearing_move.lines
+
+        for line in lines:
+            if line.account.reconcile and not line.reconciliation:
+                key = (
+                    line.account.id,
+                    line.party.id if line.party else None)
+                to_reconcile[key].append(line)
+        for lines in list(to_reconcile.values()):
+            if not sum((l.debit - l.credit) for l in lines):
+                MoveLine.reconcile(lines)
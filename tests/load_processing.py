@@ -0,0 +1,347 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""Concurrent load test of the payment processing workflow.
+
+It runs N worker processes against a PostgreSQL database where the module
+is activated and a payment journal with processing account and journal is
+configured. Each worker creates synthetic receivable lines and payments and
+then runs a random mix of process, succeed and fail on them. Succeed and
+fail pick any processing payment of the journal so workers contend for the
+same rows, and the parties are shared between workers.
+
+The lock wait is estimated by sampling the backends waiting for a lock in
+pg_stat_activity. The time lost on lock errors is the time spent in the
+attempts which failed on a deadlock, a serialization failure or a lock
+timeout, without the retry sleep.
+
+Example:
+
+    python -m \\
+        trytond.modules.account_payment_processing.tests.load_processing \\
+        -c trytond.conf -d loadtest --journal 1 --workers 8 \\
+        --mix process=2,succeed=1,fail=1
+"""
+import argparse
+import datetime as dt
+import multiprocessing
+import random
+import statistics
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent import futures
+from decimal import Decimal
+
+from sql import Flavor
+
+import trytond.config as config
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+DEADLOCK = '40P01'
+SERIALIZATION_FAILURE = '40001'
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description="Load test the payment processing workflow")
+    parser.add_argument('-c', '--config', dest='configfile', required=True,
+        help="the trytond configuration file")
+    parser.add_argument('-d', '--database', required=True,
+        help="the PostgreSQL database with the module activated")
+    parser.add_argument('--journal', type=int, required=True,
+        help="the id of the payment journal with processing")
+    parser.add_argument('--workers', type=int, default=4,
+        help="the number of worker processes (default: %(default)s)")
+    parser.add_argument('--payments', type=int, default=200,
+        help="the payments created by each worker (default: %(default)s)")
+    parser.add_argument('--operations', type=int, default=100,
+        help="the operations run by each worker (default: %(default)s)")
+    parser.add_argument('--batch', type=int, default=10,
+        help="the payments per operation (default: %(default)s)")
+    parser.add_argument('--parties', type=int, default=5,
+        help="the parties shared by the payments (default: %(default)s)")
+    parser.add_argument('--mix', default='process=2,succeed=1,fail=1',
+        help="the weight of each operation (default: %(default)s)")
+    parser.add_argument('--retry', type=int, default=5,
+        help="the retries on lock errors (default: %(default)s)")
+    parser.add_argument('--lock-sample', type=float, default=0.1,
+        help="the seconds between samples of the backends waiting for locks "
+        "(default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=0,
+        help="the seed of the random generator (default: %(default)s)")
+    args = parser.parse_args(args)
+    args.mix = {
+        k: float(v) for k, v in (i.split('=') for i in args.mix.split(','))}
+    unknown = set(args.mix) - {'process', 'succeed', 'fail'}
+    if unknown:
+        parser.error("unknown operations: %s" % ', '.join(sorted(unknown)))
+    return args
+
+
+def init(args):
+    "Initialize the pool in a new process"
+    from trytond import backend
+    config.update_etc(args.configfile)
+    Flavor.set(backend.Database.flavor)
+    pool = Pool(args.database)
+    with Transaction().start(args.database, 0, readonly=True):
+        pool.init()
+    return pool
+
+
+def get_context(pool, args):
+    PaymentJournal = pool.get('account.payment.journal')
+    with Transaction().start(args.database, 0, readonly=True):
+        journal = PaymentJournal(args.journal)
+        return {'company': journal.company.id}
+
+
+def create_payments(pool, args, index, rng):
+    "Create submitted receivable payments with their lines"
+    Account = pool.get('account.account')
+    Date = pool.get('ir.date')
+    Move = pool.get('account.move')
+    Line = pool.get('account.move.line')
+    Party = pool.get('party.party')
+    Payment = pool.get('account.payment')
+    PaymentJournal = pool.get('account.payment.journal')
+    Period = pool.get('account.period')
+
+    journal = PaymentJournal(args.journal)
+    company = journal.company
+    today = Date.today()
+    period = Period.find(company, date=today)
+    receivable, = Account.search([
+            ('type.receivable', '=', True),
+            ('party_required', '=', True),
+            ('company', '=', company.id),
+            ('closed', '!=', True),
+            ], limit=1)
+    revenue, = Account.search([
+            ('type.revenue', '=', True),
+            ('company', '=', company.id),
+            ('closed', '!=', True),
+            ], limit=1)
+    parties = [Party(name='Load Test %s' % i) for i in range(args.parties)]
+    existing = {p.name: p for p in Party.search([
+                ('name', 'in', [p.name for p in parties]),
+                ])}
+    parties = [existing.get(p.name, p) for p in parties]
+    Party.save(parties)
+
+    moves = []
+    for i in range(args.payments):
+        amount = Decimal(rng.randrange(100, 100000)) / 100
+        party = parties[(index + i) % len(parties)]
+        moves.append(Move(
+                journal=journal.processing_journal,
+                period=period,
+                date=today,
+                description='Load Test',
+                lines=[
+                    Line(account=receivable, party=party, debit=amount,
+                        credit=0),
+                    Line(account=revenue, debit=0, credit=amount),
+                    ]))
+    Move.save(moves)
+    Move.post(moves)
+
+    payments = []
+    for move in moves:
+        line, = [l for l in move.lines if l.account == receivable]
+        payments.append(Payment(
+                company=company,
+                journal=journal,
+                kind='receivable',
+                party=line.party,
+                amount=line.debit,
+                line=line,
+                date=today))
+    Payment.save(payments)
+    Payment.submit(payments)
+    return [p.id for p in payments]
+
+
+def run_operation(pool, args, operation, submitted, rng):
+    Payment = pool.get('account.payment')
+    if operation == 'process':
+        payments = Payment.browse(submitted[:args.batch])
+        if payments:
+            Payment.process_grouped(payments)
+    else:
+        payments = Payment.search([
+                ('journal', '=', args.journal),
+                ('state', '=', 'processing'),
+                ], offset=rng.randrange(args.batch * args.workers),
+            limit=args.batch, order=[('id', 'ASC')])
+        if payments:
+            getattr(Payment, operation)(payments)
+    return len(payments)
+
+
+def work(args, index, queue):
+    try:
+        queue.put(_work(args, index))
+    except Exception:
+        queue.put(None)
+        raise
+
+
+def _work(args, index):
+    from trytond import backend
+    pool = init(args)
+    rng = random.Random(args.seed + index)
+    context = get_context(pool, args)
+    with Transaction().start(args.database, 0, context=context):
+        submitted = create_payments(pool, args, index, rng)
+
+    operations, weights = zip(*args.mix.items())
+    stats = {
+        'latencies': defaultdict(list),
+        'payments': Counter(),
+        'retries': 0,
+        'deadlocks': 0,
+        'serialization_failures': 0,
+        'lock_errors': 0,
+        'lock_error_time': 0,
+        'failures': 0,
+        }
+    started = time.monotonic()
+    for _ in range(args.operations):
+        operation, = rng.choices(operations, weights)
+        for count in range(args.retry + 1):
+            start = time.monotonic()
+            try:
+                with Transaction().start(
+                        args.database, 0, context=context):
+                    done = run_operation(
+                        pool, args, operation, submitted, rng)
+            except backend.DatabaseOperationalError as exception:
+                # the time spent before the error, without the retry sleep
+                stats['lock_error_time'] += time.monotonic() - start
+                code = getattr(exception, 'pgcode', None)
+                if code == DEADLOCK:
+                    stats['deadlocks'] += 1
+                elif code == SERIALIZATION_FAILURE:
+                    stats['serialization_failures'] += 1
+                else:
+                    stats['lock_errors'] += 1
+                if count < args.retry:
+                    stats['retries'] += 1
+                    time.sleep(0.02 * (count + 1))
+            else:
+                stats['latencies'][operation].append(
+                    time.monotonic() - start)
+                stats['payments'][operation] += done
+                if operation == 'process':
+                    del submitted[:done]
+                break
+        else:
+            stats['failures'] += 1
+    stats['duration'] = time.monotonic() - started
+    return stats
+
+
+def pg_deadlocks(args):
+    "Return the deadlocks counted by PostgreSQL for the database"
+    from trytond import backend
+    database = backend.Database(args.database).connect()
+    connection = database.get_connection(autocommit=True)
+    try:
+        cursor = connection.cursor()
+        cursor.execute(
+            'SELECT deadlocks FROM pg_stat_database WHERE datname = %s',
+            (args.database,))
+        deadlocks, = cursor.fetchone()
+        return deadlocks
+    finally:
+        database.put_connection(connection)
+
+
+def sample_lock_waits(args, stop):
+    """Return the time spent by the backends of the database waiting for
+    locks, estimated from samples of pg_stat_activity"""
+    from trytond import backend
+    database = backend.Database(args.database).connect()
+    connection = database.get_connection(autocommit=True)
+    waited = 0
+    try:
+        cursor = connection.cursor()
+        while not stop.wait(args.lock_sample):
+            cursor.execute(
+                'SELECT COUNT(*) FROM pg_stat_activity '
+                'WHERE datname = %s AND wait_event_type = %s',
+                (args.database, 'Lock'))
+            waiting, = cursor.fetchone()
+            waited += waiting * args.lock_sample
+        return waited
+    finally:
+        database.put_connection(connection)
+
+
+def percentiles(values):
+    if len(values) < 2:
+        return values * 3
+    quantiles = statistics.quantiles(values, n=100, method='inclusive')
+    return [quantiles[49], quantiles[89], quantiles[98]]
+
+
+def report(args, results, deadlocks, lock_wait):
+    duration = max(r['duration'] for r in results)
+    print("Workers: %s, duration: %s" % (
+            args.workers, dt.timedelta(seconds=round(duration))))
+    print("%-8s %8s %10s %9s %9s %9s %9s" % (
+            "", "calls", "payments/s", "p50", "p90", "p99", "max"))
+    for operation in sorted(args.mix):
+        latencies = sorted(sum(
+                (r['latencies'][operation] for r in results), []))
+        payments = sum(r['payments'][operation] for r in results)
+        if not latencies:
+            continue
+        print("%-8s %8d %10.1f %9.3f %9.3f %9.3f %9.3f" % (
+                operation, len(latencies), payments / duration,
+                *percentiles(latencies), latencies[-1]))
+    for key in ['retries', 'deadlocks', 'serialization_failures',
+            'lock_errors', 'failures']:
+        print("%s: %s" % (
+                key.replace('_', ' ').capitalize(),
+                sum(r[key] for r in results)))
+    print("Lock wait: %.3fs" % lock_wait)
+    print("Time lost on lock errors: %.3fs" % sum(
+            r['lock_error_time'] for r in results))
+    print("PostgreSQL deadlocks: %s" % deadlocks)
+
+
+def main(args=None):
+    args = parse_args(args)
+    init(args)
+    deadlocks = pg_deadlocks(args)
+
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    workers = [
+        context.Process(target=work, args=(args, i, queue))
+        for i in range(args.workers)]
+    stop = threading.Event()
+    with futures.ThreadPoolExecutor(max_workers=1) as executor:
+        lock_wait = executor.submit(sample_lock_waits, args, stop)
+        for worker in workers:
+            worker.start()
+        try:
+            results = [queue.get() for _ in workers]
+        finally:
+            stop.set()
+    for worker in workers:
+        worker.join()
+    crashed = results.count(None)
+    results = [r for r in results if r is not None]
+    if crashed:
+        print("Crashed workers: %s" % crashed)
+    if results:
+        report(args, results, pg_deadlocks(args) - deadlocks,
+            lock_wait.result())
+
+
+if __name__ == '__main__':
+    main()
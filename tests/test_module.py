@@ -1,9 +1,31 @@
-
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 
-from trytond.modules.company.tests import CompanyTestMixin
-from trytond.tests.test_tryton import ModuleTestCase
+import datetime as dt
+import os
+import shutil
+import tempfile
+from concurrent import futures
+from decimal import Decimal
+from unittest.mock import patch
+
+from sql import Null
+
+import trytond.config as config
+from trytond import backend
+from trytond.modules.account.tests import create_chart, get_fiscalyear
+from trytond.modules.account_payment_processing import metrics
+from trytond.modules.account_payment_processing import \
+    payment as payment_module
+from trytond.modules.account_payment_processing.exceptions import (
+    ProcessingError, ProcessingWarning)
+from trytond.modules.company.tests import (
+    CompanyTestMixin, create_company, set_company)
+from trytond.modules.currency.tests import add_currency_rate, create_currency
+from trytond.pool import Pool
+from trytond.tests.test_tryton import (
+    DB_NAME, ModuleTestCase, with_transaction)
+from trytond.transaction import Transaction
 
 
 class AccountPaymentProcessingTestCase(CompanyTestMixin, ModuleTestCase):
@@ -11,5 +33,517 @@ class AccountPaymentProcessingTestCase(CompanyTestMixin, ModuleTestCase):
     module = 'account_payment_processing'
     extras = ['account_bank_statement_payment']
 
+    def test_metrics_render(self):
+        "Test metrics rendering in Prometheus text format"
+        counter = metrics.Counter('test_total', 'Test', ['operation'])
+        histogram = metrics.Histogram('test_seconds', 'Test', ['operation'],
+            buckets=(0.1, 1))
+        counter.inc('process', amount=3)
+        histogram.observe(0.5, 'process')
+
+        samples = list(counter.samples()) + list(histogram.samples())
+
+        self.assertEqual(samples, [
+                ('test_total', [('operation', 'process')], 3),
+                ('test_seconds_bucket',
+                    [('operation', 'process'), ('le', '0.1')], 0),
+                ('test_seconds_bucket',
+                    [('operation', 'process'), ('le', '1.0')], 1),
+                ('test_seconds_bucket',
+                    [('operation', 'process'), ('le', '+Inf')], 1),
+                ('test_seconds_count', [('operation', 'process')], 1),
+                ('test_seconds_sum', [('operation', 'process')], 0.5),
+                ])
+
+    def test_metrics_export(self):
+        "Test metrics are added to the totals shared by the processes"
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'metrics.prom')
+        if not config.has_section('account_payment_processing'):
+            config.add_section('account_payment_processing')
+        config.set('account_payment_processing', 'metrics_path', path)
+        self.addCleanup(
+            config.set, 'account_payment_processing', 'metrics_path', '')
+        metrics._reset()
+
+        metrics.payments.inc('process', amount=2)
+        metrics.duration.observe(0.5, 'process')
+        metrics.export(force=True)
+        # counts of another process
+        metrics.payments.inc('process', amount=3)
+        metrics.duration.observe(2, 'process')
+        metrics.export(force=True)
+
+        with open(path) as fp:
+            content = fp.read()
+        self.assertIn(
+            'account_payment_processing_payments_total'
+            '{operation="process"} 5.0', content)
+        self.assertIn(
+            'account_payment_processing_duration_seconds_count'
+            '{operation="process"} 2.0', content)
+        self.assertIn(
+            'account_payment_processing_duration_seconds_sum'
+            '{operation="process"} 2.5', content)
+        self.assertEqual(list(metrics.payments.samples()), [])
+
+    @with_transaction()
+    def test_process_partitions(self):
+        "Test partitions of payments and succeed delay"
+        pool = Pool()
+        Account = pool.get('account.account')
+        FiscalYear = pool.get('account.fiscalyear')
+        Journal = pool.get('account.journal')
+        Party = pool.get('party.party')
+        Payment = pool.get('account.payment')
+        PaymentJournal = pool.get('account.payment.journal')
+
+        company = create_company()
+        with set_company(company), \
+                Transaction().set_context(_skip_warnings=True):
+            create_chart(company)
+            fiscalyear = get_fiscalyear(company)
+            fiscalyear.save()
+            FiscalYear.create_period([fiscalyear])
+            receivable, = Account.search([
+                    ('type.receivable', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+            revenue, = Journal.search([
+                    ('code', '=', 'REV'),
+                    ])
+            journal = PaymentJournal(
+                name="Manual", process_method='manual',
+                currency=company.currency,
+                processing_account=receivable, processing_journal=revenue,
+                processing_succeed_delay=dt.timedelta(days=2))
+            journal.save()
+            party = Party(name="Customer")
+            party.save()
+            today = dt.date.today()
+
+            def create_payment(date):
+                payment = Payment(
+                    company=company, journal=journal, kind='receivable',
+                    party=party, amount=Decimal(10), date=date)
+                payment.save()
+                return payment
+            draft = create_payment(today)
+            pending = create_payment(today)
+            recent = create_payment(today - dt.timedelta(days=1))
+            old = create_payment(today - dt.timedelta(days=2))
+            Payment.submit([pending, recent, old])
+            Payment.process_grouped([recent, old])
+
+            partitions = Payment._get_partitions(date=today)
+
+            self.assertEqual(
+                partitions, {company.id: ([pending.id], [old.id])})
+
+            submitted = []
+
+            def process_partition(database_name, user, context, *partition):
+                submitted.append((context['company'], partition))
+                return len(partition[0]), len(partition[1]), None
+
+            with patch.object(payment_module, '_get_executor',
+                        futures.ThreadPoolExecutor), \
+                    patch.object(payment_module, '_process_partition',
+                        process_partition):
+                self.assertEqual(
+                    Payment.process_partitions(date=today),
+                    {company.id: (1, 1, None)})
+            self.assertEqual(
+                submitted, [(company.id, ([pending.id], [old.id]))])
+
+            Payment.process_partition(*partitions[company.id])
+
+            self.assertEqual(
+                [p.state for p in [draft, pending, recent, old]],
+                ['draft', 'processing', 'processing', 'succeeded'])
+            self.assertEqual(Payment._get_partitions(date=today), {})
+
+    def test_process_partitions_executor(self):
+        "Test spawned processes load the worker configuration"
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        configfile = os.path.join(directory, 'trytond.conf')
+        with open(configfile, 'w') as fp:
+            fp.write('[account_payment_processing]\nmarker = spawned\n')
+        if not config.has_section('account_payment_processing'):
+            config.add_section('account_payment_processing')
+        config.set(
+            'account_payment_processing', 'worker_config', configfile)
+        self.addCleanup(
+            config.set, 'account_payment_processing', 'worker_config', '')
+
+        with payment_module._get_executor(1) as executor:
+            marker = executor.submit(
+                config.get, 'account_payment_processing', 'marker')
+
+            self.assertEqual(marker.result(), 'spawned')
+
+    def test_process_partition_retry(self):
+        "Test partition is retried on operational errors"
+        Payment = Pool(DB_NAME).get('account.payment')
+        retry = config.getint('database', 'retry')
+
+        with patch.object(Payment, 'process_partition', side_effect=[
+                    backend.DatabaseOperationalError, None]) as process:
+            self.assertEqual(
+                payment_module._process_partition(
+                    DB_NAME, 0, {}, [1], [2, 3]),
+                (1, 2, None))
+            self.assertEqual(process.call_count, 2)
+
+        with patch.object(Payment, 'process_partition',
+                    side_effect=backend.DatabaseOperationalError) as process:
+            with self.assertRaises(backend.DatabaseOperationalError):
+                payment_module._process_partition(
+                    DB_NAME, 0, {}, [1], [2, 3])
+            self.assertEqual(process.call_count, retry + 1)
+
+    @with_transaction()
+    def test_process_checks(self):
+        "Test no processing move is created for payments failing checks"
+        pool = Pool()
+        Account = pool.get('account.account')
+        FiscalYear = pool.get('account.fiscalyear')
+        Journal = pool.get('account.journal')
+        Move = pool.get('account.move')
+        Party = pool.get('party.party')
+        Payment = pool.get('account.payment')
+        PaymentJournal = pool.get('account.payment.journal')
+        Period = pool.get('account.period')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            fiscalyear = get_fiscalyear(company)
+            fiscalyear.save()
+            FiscalYear.create_period([fiscalyear])
+            receivable, = Account.search([
+                    ('type.receivable', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+            revenue, = Account.search([
+                    ('type.revenue', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+            journal_revenue, = Journal.search([
+                    ('code', '=', 'REV'),
+                    ])
+            party = Party(name="Customer")
+            party.save()
+            today = dt.date.today()
+            period = Period.find(company, date=today)
+            eur = create_currency('eur')
+            add_currency_rate(eur, 2, date=today + dt.timedelta(days=1))
+
+            def create_journal(name, currency, **values):
+                journal = PaymentJournal(
+                    name=name, process_method='manual',
+                    currency=currency, **values)
+                journal.save()
+                return journal
+
+            def create_payment(journal, with_line=True):
+                payment = Payment(
+                    company=company, journal=journal, kind='receivable',
+                    party=party, amount=Decimal(10), date=today)
+                if with_line:
+                    second_currency = {}
+                    if journal.currency != company.currency:
+                        second_currency = {
+                            'second_currency': journal.currency,
+                            'amount_second_currency': Decimal(10),
+                            }
+                    move = Move(
+                        journal=journal_revenue, period=period, date=today,
+                        lines=[{
+                                'account': receivable, 'party': party,
+                                'debit': Decimal(5), 'credit': 0,
+                                'maturity_date': today,
+                                **second_currency,
+                                }, {
+                                'account': revenue,
+                                'debit': 0, 'credit': Decimal(5),
+                                }])
+                    move.save()
+                    Move.post([move])
+                    payment.line, = [
+                        l for l in move.lines if l.account == receivable]
+                payment.save()
+                Payment.submit([payment])
+                return payment
+
+            complete = create_journal("Complete", company.currency,
+                processing_account=receivable,
+                processing_journal=journal_revenue)
+            incomplete = create_journal("Incomplete", company.currency,
+                processing_account=receivable,
+                processing_journal=journal_revenue)
+            # the journal can only be incomplete with data written by SQL
+            journal = PaymentJournal.__table__()
+            cursor = Transaction().connection.cursor()
+            cursor.execute(*journal.update(
+                    [journal.processing_journal], [Null],
+                    where=journal.id == incomplete.id))
+            foreign = create_journal("Foreign", eur,
+                processing_account=receivable,
+                processing_journal=journal_revenue)
+
+            incomplete_payment = create_payment(incomplete)
+            closed_payment = create_payment(complete)
+            foreign_payment = create_payment(foreign)
+            no_line_payment = create_payment(complete, with_line=False)
+
+            with self.assertRaises(ProcessingError) as cm:
+                Payment.process_grouped([incomplete_payment])
+            self.assertIn(incomplete.rec_name, cm.exception.description)
+
+            Period.close([period])
+            with self.assertRaises(ProcessingError) as cm:
+                Payment.process_grouped([closed_payment])
+            self.assertIn(company.rec_name, cm.exception.description)
+            Period.reopen([period])
+
+            with self.assertRaises(ProcessingError) as cm:
+                Payment.process_grouped([foreign_payment])
+            self.assertIn(eur.rec_name, cm.exception.description)
+
+            with self.assertRaises(ProcessingWarning):
+                Payment.process_grouped([no_line_payment])
+            self.assertEqual(no_line_payment.state, 'submitted')
+
+            with Transaction().set_context(_skip_warnings=True):
+                Payment.process_grouped([no_line_payment])
+            self.assertEqual(no_line_payment.state, 'processing')
+
+            payments = [
+                incomplete_payment, closed_payment, foreign_payment,
+                no_line_payment]
+            self.assertEqual(
+                [p.state for p in payments],
+                ['submitted', 'submitted', 'submitted', 'processing'])
+            self.assertEqual([p.processing_move for p in payments], [None] * 4)
+            self.assertEqual(Move.search([
+                        ('journal', '=', journal_revenue.id),
+                        ('origin', 'like', 'account.payment,%'),
+                        ]), [])
+
+    @with_transaction()
+    def test_search_processing_status(self):
+        "Test searching payments on processing status"
+        pool = Pool()
+        Account = pool.get('account.account')
+        FiscalYear = pool.get('account.fiscalyear')
+        Journal = pool.get('account.journal')
+        Move = pool.get('account.move')
+        Party = pool.get('party.party')
+        Payment = pool.get('account.payment')
+        PaymentJournal = pool.get('account.payment.journal')
+        Period = pool.get('account.period')
+
+        company = create_company()
+        with set_company(company), \
+                Transaction().set_context(_skip_warnings=True):
+            create_chart(company)
+            fiscalyear = get_fiscalyear(company)
+            fiscalyear.save()
+            FiscalYear.create_period([fiscalyear])
+            receivable, = Account.search([
+                    ('type.receivable', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+            revenue, = Account.search([
+                    ('type.revenue', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+            journal_revenue, = Journal.search([
+                    ('code', '=', 'REV'),
+                    ])
+            journal = PaymentJournal(
+                name="Manual", process_method='manual',
+                currency=company.currency,
+                processing_account=receivable,
+                processing_journal=journal_revenue)
+            journal.save()
+            party = Party(name="Customer")
+            party.save()
+            today = dt.date.today()
+            move = Move(
+                journal=journal_revenue, period=Period.find(company),
+                date=today, lines=[{
+                        'account': receivable, 'party': party,
+                        'debit': Decimal(10), 'credit': 0,
+                        'maturity_date': today,
+                        }, {
+                        'account': revenue,
+                        'debit': 0, 'credit': Decimal(10),
+                        }])
+            move.save()
+            Move.post([move])
+            line, = [l for l in move.lines if l.account == receivable]
+            with_line = Payment(
+                company=company, journal=journal, kind='receivable',
+                party=party, amount=Decimal(10), date=today, line=line)
+            without_line = Payment(
+                company=company, journal=journal, kind='receivable',
+                party=party, amount=Decimal(10), date=today)
+            Payment.save([with_line, without_line])
+            Payment.submit([with_line, without_line])
+            Payment.process_grouped([with_line, without_line])
+
+            self.assertEqual(
+                [with_line.processing_status, without_line.processing_status],
+                ['open', None])
+            for domain, result in [
+                    (('processing_status', '=', 'open'), [with_line]),
+                    (('processing_status', '=', None), [without_line]),
+                    (('processing_status', '!=', None), [with_line]),
+                    (('processing_status', 'in', ['open']), [with_line]),
+                    (('processing_status', 'in', [None]), [without_line]),
+                    (('processing_status', 'in', ['open', None]),
+                        [with_line, without_line]),
+                    (('processing_status', 'in', []), []),
+                    (('processing_status', 'not in', ['open']), []),
+                    (('processing_status', 'not in', [None]), [with_line]),
+                    (('processing_status', 'not in', ['open', None]), []),
+                    (('processing_status', 'not in', []),
+                        [with_line, without_line]),
+                    ]:
+                with self.subTest(domain=domain):
+                    self.assertEqual(
+                        Payment.search([domain], order=[('id', 'ASC')]),
+                        result)
+
+            Payment.fail([with_line, without_line])
+
+            self.assertEqual(
+                [with_line.processing_status, without_line.processing_status],
+                ['cancelled', None])
+            self.assertEqual(
+                Payment.search([('processing_status', '=', 'cancelled')]),
+                [with_line])
+
+    @with_transaction()
+    def test_processing_event_stream(self):
+        "Test stream of events follows the order of the transactions"
+        pool = Pool()
+        Event = pool.get('account.payment.processing.event')
+        event = Event.__table__()
+        cursor = Transaction().connection.cursor()
+
+        company = create_company()
+        with set_company(company):
+            events = Event.create([{
+                        'company': company.id,
+                        'kind': 'process',
+                        'amount': Decimal(10),
+                        'currency': company.currency.id,
+                        }] * 3)
+            first, second, third = events
+
+            if backend.name == 'postgresql':
+                # the events of the running transaction are held back
+                self.assertEqual(Event.stream(), [])
+
+            # the first event is committed by a younger transaction after the
+            # second and the third events
+            for record, transaction_id in zip(events, [3, 1, 2]):
+                cursor.execute(*event.update(
+                        [event.transaction_id], [transaction_id],
+                        where=event.id == record.id))
+
+            streamed = Event.stream(limit=2)
+            self.assertEqual(
+                [e['id'] for e in streamed], [second.id, third.id])
+            self.assertEqual(streamed[-1]['cursor'], [2, third.id])
+
+            streamed = Event.stream(after=streamed[-1]['cursor'])
+            self.assertEqual([e['id'] for e in streamed], [first.id])
+
+            self.assertEqual(Event.stream(after=streamed[-1]['cursor']), [])
+
+
+    @with_transaction()
+    def test_clearing_move(self):
+        "Test clearing moves of processing payments use the processing account"
+        pool = Pool()
+        Account = pool.get('account.account')
+        FiscalYear = pool.get('account.fiscalyear')
+        Journal = pool.get('account.journal')
+        Move = pool.get('account.move')
+        Party = pool.get('party.party')
+        Payment = pool.get('account.payment')
+        PaymentJournal = pool.get('account.payment.journal')
+        Period = pool.get('account.period')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            fiscalyear = get_fiscalyear(company)
+            fiscalyear.save()
+            FiscalYear.create_period([fiscalyear])
+            receivable, = Account.search([
+                    ('type.receivable', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+            revenue, = Account.search([
+                    ('type.revenue', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+            processing, clearing = Account.copy([receivable, receivable])
+            clearing.party_required = False
+            clearing.save()
+            journal_revenue, = Journal.search([
+                    ('code', '=', 'REV'),
+                    ])
+            journal = PaymentJournal(
+                name="Manual", process_method='manual',
+                currency=company.currency,
+                processing_account=processing,
+                processing_journal=journal_revenue,
+                clearing_account=clearing,
+                clearing_journal=journal_revenue)
+            journal.save()
+            party = Party(name="Customer")
+            party.save()
+            today = dt.date.today()
+            moves = [Move(
+                    journal=journal_revenue, period=Period.find(company),
+                    date=today, lines=[{
+                            'account': receivable, 'party': party,
+                            'debit': amount, 'credit': 0,
+                            'maturity_date': today,
+                            }, {
+                            'account': revenue,
+                            'debit': 0, 'credit': amount,
+                            }])
+                for amount in [Decimal(10), Decimal(20)]]
+            Move.save(moves)
+            Move.post(moves)
+            payments = [Payment(
+                    company=company, journal=journal, kind='receivable',
+                    party=party, amount=line.debit, date=today, line=line)
+                for m in moves for line in m.lines
+                if line.account == receivable]
+            Payment.save(payments)
+            Payment.submit(payments)
+            Payment.process_grouped(payments)
+
+            Payment.succeed(payments)
+
+            for payment in payments:
+                self.assertEqual(
+                    sorted((l.account, l.party, l.debit, l.credit)
+                        for l in payment.clearing_move.lines),
+                    sorted([
+                            (clearing, None, payment.amount, 0),
+                            (processing, party, 0, payment.amount),
+                            ]))
+
 
 del ModuleTestCase
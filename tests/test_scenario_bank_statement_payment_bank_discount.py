@@ -163,6 +163,18 @@ class Test(unittest.TestCase):
         self.assertEqual(customer_invoice.state, 'paid')
         self.assertNotEqual(payment.processing_move, None)
         self.assertEqual(payment.clearing_move, None)
+        group = payment.group
+        self.assertEqual(group.processing_amount, Decimal('100.00'))
+        self.assertEqual(group.processing_pending_amount, Decimal('100.00'))
+        self.assertEqual(group.processing_failed_amount, Decimal('0.00'))
+        self.assertEqual(payment.processing_status, 'open')
+        self.assertEqual(
+            Payment.find([('processing_status', '=', 'open')]), [payment])
+        ProcessingEvent = Model.get('account.payment.processing.event')
+        event, = ProcessingEvent.find([('payment', '=', payment.id)])
+        self.assertEqual(event.kind, 'process')
+        self.assertEqual(event.move, payment.processing_move)
+        self.assertEqual(event.move_amount, Decimal('100.00'))
 
         # Create and confirm bank statement
         BankStatement = Model.get('account.bank.statement')
@@ -193,6 +205,15 @@ class Test(unittest.TestCase):
         # substract the advanced amount is because the payment succeeded
         payment.click('succeed')
         self.assertNotEqual(payment.clearing_move, None)
+        _, event = ProcessingEvent.find(
+            [('payment', '=', payment.id)], order=[('id', 'ASC')])
+        self.assertEqual(event.kind, 'succeed')
+        self.assertEqual(event.move, payment.clearing_move)
+        self.assertEqual(event.move_amount, Decimal('100.00'))
+        group.reload()
+        self.assertEqual(group.processing_amount, Decimal('100.00'))
+        self.assertEqual(group.processing_pending_amount, Decimal('0.00'))
+        self.assertEqual(group.processing_failed_amount, Decimal('0.00'))
 
         # Now, the invoice is paid, the customer's due amount is zero, also owr due with
         # bank
@@ -228,6 +249,15 @@ class Test(unittest.TestCase):
         payment.reload()
         self.assertEqual(payment.state, 'failed')
         self.assertEqual(payment.clearing_move, None)
+        _, _, event = ProcessingEvent.find(
+            [('payment', '=', payment.id)], order=[('id', 'ASC')])
+        self.assertEqual(event.kind, 'fail')
+        self.assertNotEqual(event.move, None)
+        self.assertEqual(event.move_amount, Decimal('100.00'))
+        group.reload()
+        self.assertEqual(group.processing_amount, Decimal('0.00'))
+        self.assertEqual(group.processing_pending_amount, Decimal('0.00'))
+        self.assertEqual(group.processing_failed_amount, Decimal('100.00'))
         customer_invoice.reload()
         self.assertEqual(customer_invoice.state, 'posted')
         receivable.reload()
@@ -306,6 +336,10 @@ class Test(unittest.TestCase):
         payment2.click('process_wizard')
         payment2.reload()
         self.assertEqual(payment2.state, 'processing')
+        self.assertEqual(
+            payment2.group.processing_amount, Decimal('160.00'))
+        self.assertEqual(
+            payment2.group.processing_pending_amount, Decimal('160.00'))
 
         # And another payment with 100% bank discount for the second one
         line, = [
@@ -417,3 +451,105 @@ class Test(unittest.TestCase):
         self.assertEqual(customer_bank_discounts.balance, Decimal('0.00'))
         account_cash.reload()
         self.assertEqual(account_cash.balance, Decimal('300.00'))
+
+        # Create a payment journal settled by the bank statements
+        payment_receivable_settle_journal = PaymentJournal(
+            name='Manual receivable settled by statement',
+            process_method='manual',
+            processing_journal=revenue_journal,
+            processing_account=customer_processing_payments,
+            processing_statement_settle=True)
+        payment_receivable_settle_journal.save()
+
+        # Create two customer invoices paid with it
+        settled_payments = []
+        for amount in [Decimal('50'), Decimal('30')]:
+            customer_invoice = Invoice(type='out')
+            customer_invoice.party = customer
+            customer_invoice.payment_term = payment_term
+            invoice_line = customer_invoice.lines.new()
+            invoice_line.quantity = 1
+            invoice_line.unit_price = amount
+            invoice_line.account = revenue
+            invoice_line.description = 'Test settle'
+            customer_invoice.save()
+            customer_invoice.click('post')
+            line, = [
+                l for l in customer_invoice.move.lines
+                if l.account == receivable
+            ]
+            pay_line = Wizard('account.move.line.pay', [line])
+            pay_line.execute('next_')
+            pay_line.form.journal = payment_receivable_settle_journal
+            pay_line.execute('next_')
+            payment, = Payment.find([('state', '=', 'draft')])
+            payment.click('submit')
+            payment.click('process_wizard')
+            payment.reload()
+            self.assertEqual(payment.state, 'processing')
+            self.assertEqual(payment.processing_status, 'open')
+            settled_payments.append(payment)
+        payment4, payment5 = settled_payments
+
+        # The bank statement receives the first payment and returns the second
+        statement6 = BankStatement(journal=statement_journal, date=now)
+        statement_line = statement6.lines.new()
+        statement_line.date = now
+        statement_line.description = 'Settlement of fourth invoice'
+        statement_line.amount = Decimal('50.0')
+        statement_line = statement6.lines.new()
+        statement_line.date = now
+        statement_line.description = 'Return of fifth invoice'
+        statement_line.amount = Decimal('-30.0')
+        statement6.save()
+        statement6.click('confirm')
+        self.assertEqual(statement6.state, 'confirmed')
+
+        # Posting the positive line succeeds the payment and reconciles the
+        # processing account
+        statement_line8, statement_line9 = statement6.lines
+        st_move_line = statement_line8.lines.new()
+        st_move_line.payment = payment4
+        self.assertEqual(st_move_line.amount, Decimal('50.00'))
+        self.assertEqual(
+            st_move_line.account.name, 'Customers Processing Payments')
+        statement_line8.save()
+        statement_line8.click('post')
+        payment4.reload()
+        self.assertEqual(payment4.state, 'succeeded')
+        self.assertEqual(payment4.processing_status, 'reconciled')
+        self.assertEqual(
+            payment4.group.processing_pending_amount, Decimal('0.00'))
+        st_move_line, = statement_line8.lines
+        line, = [
+            l for l in st_move_line.move.lines
+            if l.account == customer_processing_payments
+        ]
+        self.assertNotEqual(line.reconciliation, None)
+        processing_line, = [
+            l for l in payment4.processing_move.lines
+            if l.account == customer_processing_payments
+        ]
+        self.assertEqual(processing_line.reconciliation, line.reconciliation)
+
+        # Posting the negative line fails the payment, cancels the
+        # processing move and owes again the returned amount
+        st_move_line = statement_line9.lines.new()
+        st_move_line.payment = payment5
+        self.assertEqual(st_move_line.amount, Decimal('-30.00'))
+        self.assertEqual(
+            st_move_line.account.name, 'Customers Processing Payments')
+        statement_line9.save()
+        statement_line9.click('post')
+        payment5.reload()
+        self.assertEqual(payment5.state, 'failed')
+        self.assertEqual(payment5.processing_status, 'cancelled')
+        self.assertEqual(payment5.processing_move, None)
+        self.assertEqual(
+            payment5.group.processing_failed_amount, Decimal('30.00'))
+        st_move_line, = statement_line9.lines
+        self.assertEqual(st_move_line.account, receivable)
+        self.assertEqual([
+                l for l in st_move_line.move.lines
+                if l.account == customer_processing_payments
+                ], [])